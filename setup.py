@@ -0,0 +1,13 @@
+from setuptools import Extension, setup
+
+# The compiled Needleman-Wunsch kernel is optional, if it fails to build the aligner falls back to numba or NumPy
+setup(
+    ext_modules=[
+        Extension(
+            "script_aligner.aligners._nw",
+            ["src/script_aligner/aligners/_nw.pyx"],
+            extra_compile_args=["-O3"],
+            optional=True,
+        )
+    ]
+)
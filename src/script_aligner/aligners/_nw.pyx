@@ -0,0 +1,48 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, initializedcheck=False
+from libc.stdint cimport int8_t, int16_t, int32_t
+
+# Traceback directions, these must match the DIRECTION_* constants in needleman.py
+cdef enum:
+    DIRECTION_DIAG = 0
+    DIRECTION_UP = 1
+    DIRECTION_LEFT = 2
+
+# The cost matrix is int16 unless the inputs are large enough that it could overflow
+ctypedef fused cost_t:
+    int16_t
+    int32_t
+
+
+def nw_fill(const int8_t[:, ::1] score, int indel, cost_t[:, ::1] nw, int8_t[:, ::1] dirm):
+    # Fill the cost and direction matrices (both (M + 1) x (N + 1)) for the Needleman-Wunsch algorithm, in place
+    cdef Py_ssize_t M = score.shape[0]
+    cdef Py_ssize_t N = score.shape[1]
+    cdef Py_ssize_t i, j
+    cdef int diag_score, up_score, left_score
+
+    with nogil:
+        # The first row and column are gaps all the way
+        for j in range(N + 1):
+            nw[0, j] = indel * j
+            dirm[0, j] = DIRECTION_LEFT
+        for i in range(1, M + 1):
+            nw[i, 0] = indel * i
+            dirm[i, 0] = DIRECTION_UP
+
+        for i in range(1, M + 1):
+            for j in range(1, N + 1):
+                # Get the scores for the three possible directions
+                diag_score = nw[i - 1, j - 1] + score[i - 1, j - 1]
+                up_score = nw[i - 1, j] + indel
+                left_score = nw[i, j - 1] + indel
+
+                # Fill the cell with the maximum score, and the direction matrix with where it came from
+                if diag_score >= up_score and diag_score >= left_score:
+                    nw[i, j] = diag_score
+                    dirm[i, j] = DIRECTION_DIAG
+                elif up_score >= left_score:
+                    nw[i, j] = up_score
+                    dirm[i, j] = DIRECTION_UP
+                else:
+                    nw[i, j] = left_score
+                    dirm[i, j] = DIRECTION_LEFT
@@ -1,13 +1,39 @@
+import hashlib
 import json
-from functools import lru_cache
-from xml.etree import ElementTree
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
 
+import diskcache
 import numpy as np
 import pysrt
-from Levenshtein import distance
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
 from rich.progress import Progress
 
+try:
+    from script_aligner.aligners import _nw
+except ImportError:
+    _nw = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 NORM = None
+NORM_CACHE = None
+NORM_CACHE_DIR = os.path.expanduser("~/.cache/script_aligner/norm")
+NORM_BATCH_SIZE = 64
+# Every worker builds its own (slow, memory hungry) Normalizer, so the pool is kept small and is only worth starting
+# when there are enough uncached texts to amortize that
+NORM_MAX_WORKERS = 4
+NORM_POOL_MIN_TEXTS = 1024
+MATCH_SCORE_BLOCK_ROWS = 256
+
+_TAG_RE = re.compile(r"<[^>]+>")
 
 
 def _prepare_aligner():
@@ -24,7 +50,26 @@ def _prepare_aligner():
     NORM = Normalizer(input_case="cased", lang="en")
 
 
-INDEL_PENALTY = -0.1
+def _norm_cache():
+    # Normalized strings are persisted across runs, since the WFST normalizer is slow
+    global NORM_CACHE
+    if NORM_CACHE is None:
+        NORM_CACHE = diskcache.Cache(NORM_CACHE_DIR)
+    return NORM_CACHE
+
+
+# Scores are scaled by 10 (from +1 / -0.5 / -0.1) so that the DP runs in small integers
+MATCH_SCORE = 10
+MISMATCH_SCORE = -5
+INDEL_PENALTY = -1
+
+# Traceback directions, packed into a single int8 per cell of the direction matrix
+DIRECTION_DIAG = 0
+DIRECTION_UP = 1
+DIRECTION_LEFT = 2
+
+# Above this many cells, align with Hirschberg's linear-memory algorithm instead of a full direction matrix
+HIRSCHBERG_MIN_CELLS = 16_000_000
 
 
 def prepare_data_for_alignment(script_events, subtitles):
@@ -46,14 +91,7 @@ def load_srt_file(dialogue_file):
     subs = pysrt.open(dialogue_file)
     for s in subs:
         # Remove font XML tags
-        if "<" in s.text:
-            try:
-                tree = ElementTree.fromstring(s.text)
-                notags = ElementTree.tostring(tree, encoding="utf8", method="text").decode("utf8")
-            except ElementTree.ParseError:
-                notags = s.text
-        else:
-            notags = s.text
+        notags = _TAG_RE.sub("", s.text) if "<" in s.text else s.text
 
         subtitles.append({"text": notags, "start": s.start.ordinal, "end": s.end.ordinal})
 
@@ -73,103 +111,273 @@ def _load_data(script_file, dialogue_file):
     return d_events, s_events
 
 
-@lru_cache(maxsize=None)
+def _norm_key(s1):
+    return hashlib.sha1(s1.encode("utf8")).hexdigest()
+
+
+@cache
 def _normalize(s1):
-    global NORM
-    if NORM is None:
-        _prepare_aligner()
-    assert NORM is not None, "Normalizer not initialized"
+    # NORM must already be set up, either by _normalize_texts or by _init_worker_norm
     return NORM.normalize(s1)
 
 
-def _match(s1, s2):
-    # e1 = model.encode([s1], convert_to_tensor=True).cpu()
-    # e2 = model.encode([s2], convert_to_tensor=True).cpu()
-    s1 = _normalize(s1)
-    s2 = _normalize(s2)
+def _init_worker_norm():
+    # The NeMo Normalizer isn't picklable, so each worker process builds its own
+    _prepare_aligner()
 
-    # Compute the normalized levenstein distance
-    ls = 1 - (distance(s1, s2) / max(len(s1), len(s2)))
 
-    # return util.cos_sim(e1, e2)[0][0] + ls
-    return 1 if ls > 0.4 else -0.5
+def _norm_batch(texts):
+    return [_normalize(text) for text in texts]
+
+
+def _normalize_texts(texts, progress=None):
+    # Normalize a set of texts, using the disk cache where possible and a process pool for the rest
+    norm_cache = _norm_cache()
+    normalized = {}
+    missing = []
+    for text in texts:
+        cached = norm_cache.get(_norm_key(text))
+        if cached is None:
+            missing.append(text)
+        else:
+            normalized[text] = cached
+
+    if not missing:
+        return normalized
+
+    if len(missing) < NORM_POOL_MIN_TEXTS:
+        # Not worth starting worker processes (each with its own Normalizer) for this few texts
+        if NORM is None:
+            _prepare_aligner()
+        for text, result in zip(missing, _norm_batch(missing)):
+            norm_cache.set(_norm_key(text), result)
+            normalized[text] = result
+        return normalized
+
+    chunks = [missing[k : k + NORM_BATCH_SIZE] for k in range(0, len(missing), NORM_BATCH_SIZE)]
+    task = progress.add_task("[cyan]Normalizing...", total=len(missing)) if progress is not None else None
+    # Spawn rather than fork, since forking while the Rich progress thread is running can deadlock the workers
+    with ProcessPoolExecutor(
+        max_workers=min(os.cpu_count() or 1, NORM_MAX_WORKERS, len(chunks)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker_norm,
+    ) as pool:
+        for chunk, results in zip(chunks, pool.map(_norm_batch, chunks)):
+            for text, result in zip(chunk, results):
+                norm_cache.set(_norm_key(text), result)
+                normalized[text] = result
+            if task is not None:
+                progress.update(task, advance=len(chunk))
+
+    return normalized
+
+
+def _text_ids(data):
+    # Assign each unique text a small integer id, returning the unique texts (in id order) and the id of every element
+    ids = {}
+    element_ids = np.array([ids.setdefault(e["text"], len(ids)) for e in data], dtype=np.intp)
+    return list(ids), element_ids
+
+
+def _match_scores(script_data, sub_data, progress=None):
+    # Repeated lines (e.g. short dialogue beats) are only normalized and scored once
+    d_texts, d_ids = _text_ids(script_data)
+    s_texts, s_ids = _text_ids(sub_data)
+
+    # Normalize each unique text once
+    normalized = _normalize_texts(set(d_texts) | set(s_texts), progress)
+    d_norm = [normalized[text] for text in d_texts]
+    s_norm = [normalized[text] for text in s_texts]
+
+    # Compute the normalized levenstein similarity between every script/subtitle pair, a block of script rows per
+    # call, thresholding straight into the score matrix so the full similarity matrix is never materialized
+    score = np.empty((len(d_norm), len(s_norm)), dtype=np.int8)
+    task = progress.add_task("[cyan]Scoring...", total=len(d_norm)) if progress is not None else None
+    for k in range(0, len(d_norm), MATCH_SCORE_BLOCK_ROWS):
+        sim = cdist(
+            d_norm[k : k + MATCH_SCORE_BLOCK_ROWS],
+            s_norm,
+            scorer=Levenshtein.normalized_similarity,
+            workers=-1,
+            dtype=np.float32,
+        )
+        score[k : k + MATCH_SCORE_BLOCK_ROWS] = np.where(sim > 0.4, MATCH_SCORE, MISMATCH_SCORE)
+        if task is not None:
+            progress.update(task, advance=len(sim))
+
+    # Expand the unique scores back out to every script/subtitle pair
+    return score[np.ix_(d_ids, s_ids)]
+
+
+def _nw_fill_rows(score, indel):
+    M, N = score.shape
+
+    # Build the cost matrix for the Needleman-Wunsch algorithm (every cell is written below)
+    nw_matrix = np.empty((M + 1, N + 1), dtype=np.asarray(indel).dtype)
+    # Build the direction matrix for the Needleman-Wunsch algorithm (every cell is written below)
+    direction_matrix = np.empty((M + 1, N + 1), dtype=np.int8)
+
+    # The first row and column are gaps all the way
+    nw_matrix[0, :] = indel * np.arange(N + 1)
+    nw_matrix[:, 0] = indel * np.arange(M + 1)
+    direction_matrix[:, 0] = DIRECTION_UP
+    direction_matrix[0, :] = DIRECTION_LEFT
+
+    for i in range(1, M + 1):
+        for j in range(1, N + 1):
+            # Get the scores for the three possible directions
+            diag_score = nw_matrix[i - 1, j - 1] + score[i - 1, j - 1]
+            up_score = nw_matrix[i - 1, j] + indel
+            left_score = nw_matrix[i, j - 1] + indel
+
+            # Fill the cell with the maximum score, and the direction matrix with where it came from
+            if diag_score >= up_score and diag_score >= left_score:
+                nw_matrix[i, j] = diag_score
+                direction_matrix[i, j] = DIRECTION_DIAG
+            elif up_score >= left_score:
+                nw_matrix[i, j] = up_score
+                direction_matrix[i, j] = DIRECTION_UP
+            else:
+                nw_matrix[i, j] = left_score
+                direction_matrix[i, j] = DIRECTION_LEFT
+
+    return direction_matrix
+
+
+def _nw_fill_wavefront(score, indel):
+    # Pure NumPy fill, used when numba is not available. Every cell on an anti-diagonal (i + j == p) only depends
+    # on the two previous anti-diagonals, so each diagonal can be filled with a single vectorized max.
+    M, N = score.shape
+
+    direction_matrix = np.empty((M + 1, N + 1), dtype=np.int8)
+    direction_matrix[:, 0] = DIRECTION_UP
+    direction_matrix[0, :] = DIRECTION_LEFT
+
+    # Rolling anti-diagonal buffers, indexed by row. Only the cells on each diagonal are ever read, so they start
+    # out empty apart from the origin.
+    prev2 = np.empty(M + 1, dtype=indel.dtype)
+    prev1 = np.empty(M + 1, dtype=indel.dtype)
+    current = np.empty(M + 1, dtype=indel.dtype)
+    prev1[0] = 0
+
+    for p in range(1, M + N + 1):
+        # The first row and column are gaps all the way
+        if p <= N:
+            current[0] = indel * p
+        if p <= M:
+            current[p] = indel * p
+
+        lo, hi = max(1, p - N), min(M, p - 1)
+        if lo <= hi:
+            rows = np.arange(lo, hi + 1)
+            candidates = np.stack(
+                (
+                    prev2[lo - 1 : hi] + score[rows - 1, p - rows - 1],
+                    prev1[lo - 1 : hi] + indel,
+                    prev1[lo : hi + 1] + indel,
+                )
+            )
+            # argmax picks the first maximum, so ties prefer diag, then up, then left (as in _nw_fill_rows)
+            current[lo : hi + 1] = candidates.max(axis=0)
+            direction_matrix[rows, p - rows] = candidates.argmax(axis=0)
+
+        prev2, prev1, current = prev1, current, prev2
+
+    return direction_matrix
+
+
+def _nw_fill_compiled(score, indel):
+    # Fill using the compiled kernel from _nw.pyx, which works in place on preallocated matrices
+    M, N = score.shape
+    nw_matrix = np.empty((M + 1, N + 1), dtype=indel.dtype)
+    direction_matrix = np.empty((M + 1, N + 1), dtype=np.int8)
+    _nw.nw_fill(np.ascontiguousarray(score, dtype=np.int8), int(indel), nw_matrix, direction_matrix)
+    return direction_matrix
+
+
+# Prefer the compiled kernel, then the numba JIT, then the NumPy wavefront
+if _nw is not None:
+    _nw_fill = _nw_fill_compiled
+elif numba is not None:
+    _nw_fill = numba.njit(cache=True, boundscheck=False)(_nw_fill_rows)
+else:
+    _nw_fill = _nw_fill_wavefront
+
+
+def _cost_dtype(M, N):
+    # Every cell of the cost matrix lies between INDEL_PENALTY * (M + N) (all gaps) and MATCH_SCORE * min(M, N) (all
+    # matches), so int16 is enough unless the inputs are very large
+    bound = max(-INDEL_PENALTY * (M + N), MATCH_SCORE * min(M, N)) - MISMATCH_SCORE
+    return np.int16 if bound <= np.iinfo(np.int16).max else np.int32
+
+
+def _traceback(direction_matrix, row_offset=0, col_offset=0):
+    # Backtrack through the direction matrix to get the alignment, filling it in from the end
+    i, j = direction_matrix.shape[0] - 1, direction_matrix.shape[1] - 1
+    alignment = [None] * (i + j)
+    k = i + j - 1
+    while i > 0 or j > 0:
+        direction = direction_matrix[i, j]
+        if direction == DIRECTION_DIAG:
+            alignment[k] = (row_offset + i - 1, col_offset + j - 1)
+            i -= 1
+            j -= 1
+        elif direction == DIRECTION_UP:
+            alignment[k] = (row_offset + i - 1, None)
+            i -= 1
+        else:
+            alignment[k] = (None, col_offset + j - 1)
+            j -= 1
+        k -= 1
+
+    # Diagonal steps cover two cells at once, so the front of the list is unused
+    return alignment[k + 1 :]
+
+
+def _nw_last_row(score, indel):
+    # The last row of the Needleman-Wunsch cost matrix, computed one row at a time in O(N) memory
+    N = score.shape[1]
+    offsets = int(indel) * np.arange(N + 1, dtype=np.int32)
+    row = offsets.copy()
+    for i in range(score.shape[0]):
+        best = np.empty(N + 1, dtype=np.int32)
+        best[0] = row[0] + indel
+        best[1:] = np.maximum(row[:-1] + score[i], row[1:] + indel)
+        # Gaps along the row: row[j] = max over k <= j of best[k] + indel * (j - k)
+        row = np.maximum.accumulate(best - offsets) + offsets
+    return row
+
+
+def _hirschberg(score, indel, row_offset=0, col_offset=0):
+    # Hirschberg's divide-and-conquer alignment: O(M * N) time, but only O(N) memory outside of small sub-problems
+    M, N = score.shape
+    if M <= 1 or N <= 1 or M * N <= HIRSCHBERG_MIN_CELLS:
+        return _traceback(_nw_fill(score, indel), row_offset, col_offset)
+
+    # Find the column where the optimal alignment crosses the middle row
+    mid = M // 2
+    forward = _nw_last_row(score[:mid], indel)
+    backward = _nw_last_row(score[mid:, ::-1][::-1], indel)[::-1]
+    split = int(np.argmax(forward + backward))
+
+    return _hirschberg(score[:mid, :split], indel, row_offset, col_offset) + _hirschberg(
+        score[mid:, split:], indel, row_offset + mid, col_offset + split
+    )
 
 
 def align(script_events, subtitles):
     script_data, sub_data = prepare_data_for_alignment(script_events, subtitles)
 
-    # Build the cost matrix for the Needleman-Wunsch algorithm
-    nw_matrix = np.zeros((len(script_data) + 1, len(sub_data) + 1))
-    # Build the direction matrix for the Needleman-Wunsch algorithm
-    direction_matrix = np.zeros((len(script_data) + 1, len(sub_data) + 1))
-
     # model = SentenceTransformer("all-MiniLM-L6-v2").cuda()
 
-    # We need to fill the rest of the matrix diagonally, following the Needleman-Wunsch algorithm
+    # Progress is only reported between chunks of the precompute, the alignment itself is a single compiled call
     with Progress() as progress:
-        task = progress.add_task("[cyan]Aligning...", total=(max(len(script_data), len(sub_data)) + 1) * 2)
-
-        for diagonal in range(0, (max(len(script_data), len(sub_data)) + 1) * 2):
-            # For each diagonal, we need to fill the cells in the diagonal
-            # The diagonal is the set of cells where the row index + column index = diagonal
-            for i in range(diagonal + 1):
-                j = diagonal - i
-                # If the cell is out of bounds, skip it
-                if i >= len(script_data) + 1 or j >= len(sub_data) + 1:
-                    continue
-
-                # If the cell is on the diagonal, we need to fill it
-                if i == 0 or j == 0:
-                    nw_matrix[i, j] = INDEL_PENALTY * diagonal
-                    if i == 0:
-                        direction_matrix[i, j] = 2
-                    else:
-                        direction_matrix[i, j] = 1
-                    continue
-
-                # Get the scores for the three possible directions
-                diag_score = nw_matrix[i - 1, j - 1] + _match(script_data[i - 1]["text"], sub_data[j - 1]["text"])
-
-                up_score = nw_matrix[i - 1, j] + INDEL_PENALTY
-                left_score = nw_matrix[i, j - 1] + INDEL_PENALTY
-
-                # Get the maximum score
-                max_score = max(diag_score, up_score, left_score)
-
-                # Fill the cell with the maximum score
-                nw_matrix[i, j] = max_score
-
-                # Fill the direction matrix
-                if max_score == diag_score:
-                    direction_matrix[i, j] = 0
-                elif max_score == up_score:
-                    direction_matrix[i, j] = 1
-                elif max_score == left_score:
-                    direction_matrix[i, j] = 2
-
-            progress.update(task, advance=1)
-
-        # Print the cost matrix (pretty)
-        # print(nw_matrix)
-
-    # Now we need to backtrack through the direction matrix to get the alignment
-    alignment = []
-    i = len(script_data)
-    j = len(sub_data)
-    while i > 0 or j > 0:
-        if direction_matrix[i, j] == 0:
-            alignment.append((i - 1, j - 1))
-            i -= 1
-            j -= 1
-        elif direction_matrix[i, j] == 1:
-            alignment.append((i - 1, None))
-            i -= 1
-        elif direction_matrix[i, j] == 2:
-            alignment.append((None, j - 1))
-            j -= 1
+        score = _match_scores(script_data, sub_data, progress)
 
-    # Reverse the alignment
-    alignment.reverse()
+        # Align with the Needleman-Wunsch algorithm, using Hirschberg's algorithm for very large inputs
+        task = progress.add_task("[cyan]Aligning...", total=None)
+        alignment = _hirschberg(score, _cost_dtype(*score.shape)(INDEL_PENALTY))
+        progress.update(task, total=1, completed=1)
 
     # Write the results to a file
     for sample in script_events:
@@ -1,24 +1,32 @@
 import json
 import logging
 import re
+from collections.abc import Iterable
 
+import numpy as np
 
-def _filter_and_transform_lines(lines: list):
+_SCENE_RE = re.compile(r"^[A-Z]?\d+(pt)?\s")
+_CONT_RE = re.compile(r"CONTINUED: \(\d+\)")
+_REV_RE = re.compile(r"Revision\s+\d+\.")
+_WS2_RE = re.compile(r"\s{2,}")
+_PAREN_RE = re.compile(r"\(.*?\)")
+
+
+def _filter_and_transform_lines(lines: Iterable[str]):
     for line in lines:
         line = line.replace("\t", "    ")  # Replace tabs with spaces
 
         # If the line starts with a scene identifier, then replace ONLY the identifer with spaces
         # Scene identifiers match [A-Z]?\d+\s
-        match = re.match(r"([A-Z]?\d+(pt)?\s)", line)
-        if match:
-            line = line.replace(match.group(1), " " * len(match.group(1)))
+        line = _SCENE_RE.sub(lambda match: " " * len(match.group(0)), line, count=1)
 
         # Now check to see if the line is (MORE), (CONTINUED) etc.
-        if line.strip().upper() in ("(MORE)", "(CONT'D)", "(CONTINUED)"):
+        stripped = line.strip()
+        if stripped.upper() in ("(MORE)", "(CONT'D)", "(CONTINUED)"):
             continue
-        if re.match(r"CONTINUED: \(\d+\)", line.strip()):
+        if _CONT_RE.match(stripped):
             continue
-        if re.match(r"Revision\s+\d+.", line.strip()):
+        if _REV_RE.match(stripped):
             continue
 
         yield line
@@ -26,13 +34,20 @@ def _filter_and_transform_lines(lines: list):
 
 def _read_script(script_path: str) -> (list, int, int):
     # Return a list of lines, and the width of the script.
+    script_lines = []
+    script_width = 0
+    script_indent = None
     with open(script_path) as f:
-        script_lines = list(_filter_and_transform_lines(f.readlines()))
-
-    script_width = max(len(line) for line in script_lines)
-    script_indent = min(len(line) - len(line.lstrip()) for line in script_lines)
+        for line in _filter_and_transform_lines(f):
+            script_lines.append(line)
+            script_width = max(script_width, len(line))
+            # Blank lines don't tell us anything about the indent of the script
+            stripped_length = len(line.lstrip())
+            if stripped_length:
+                indent = len(line) - stripped_length
+                script_indent = indent if script_indent is None else min(script_indent, indent)
 
-    return script_lines, script_width, script_indent
+    return script_lines, script_width, script_indent or 0
 
 
 def _line_length(line: str, script_width: int) -> int:
@@ -58,29 +73,23 @@ def _autoset_ltol_rtol(
 
     # This is a distribution of the whitespace at the start and end of each line.
     # Create a histogram of the whitespace at the start and end of each line.
-    try:
-        start_histogram = {
-            i: start_whitespaces.count(i) / len(start_whitespaces) for i in range(max(start_whitespaces) + 1)
-        }
-    except ValueError:
-        # Maybe the max iterable argument is empty. In that case, just return the default value.
+    if not start_whitespaces:
+        # There are no lines to build a histogram from. In that case, just return the default value.
         logging.warning(f"AutoAligner: Could not determine ltol from auto-aligner: {start_whitespaces}")
         return ltol or 8, rtol or 6
-    # end_histogram = {i: end_whitespaces.count(i) for i in range(max(end_whitespaces) + 1)}
+    start_counts = np.bincount(start_whitespaces)
+    start_histogram = start_counts / start_counts.sum()
+    # end_histogram = np.bincount(end_whitespaces)
 
     # Split the histogram into chunks separated by 0s
-    start_histogram_chunks = []
-    current_chunk = []
-    for i in range(max(start_whitespaces) + 1):
-        if start_histogram[i] < auto_aligner_tolerance:
-            if current_chunk:
-                start_histogram_chunks.append(current_chunk)
-                current_chunk = []
-        else:
-            current_chunk.append(i)
+    frequent_whitespaces = np.nonzero(start_histogram >= auto_aligner_tolerance)[0]
+    start_histogram_chunks = np.split(frequent_whitespaces, np.nonzero(np.diff(frequent_whitespaces) > 1)[0] + 1)
+    # A chunk is only closed by a following bin below the tolerance, so a chunk that runs up to the last bin is dropped
+    if frequent_whitespaces.size and frequent_whitespaces[-1] == len(start_histogram) - 1:
+        start_histogram_chunks = start_histogram_chunks[:-1]
 
     # Remove empty chunks
-    start_histogram_chunks = [chunk for chunk in start_histogram_chunks if chunk]
+    start_histogram_chunks = [chunk.tolist() for chunk in start_histogram_chunks if chunk.size]
     # Get the biggest number in the second chunk, if it exists
     if len(start_histogram_chunks) > 1:
         ltol = max(start_histogram_chunks[1]) + 1
@@ -100,16 +109,15 @@ def _determine_block_alignment(
     # Check the whitespace at the beginning of each line
     whitespace_at_start_of_line = [len(line) - len(line.lstrip()) for line in block]
     whitespace_at_end_of_line = [script_width - len(line.rstrip()) for line in block]
-    if all(
-        w_start > ltol and w_end > rtol
-        for w_start, w_end in zip(whitespace_at_start_of_line, whitespace_at_end_of_line)
+    if all(w_start > ltol for w_start in whitespace_at_start_of_line) and all(
+        w_end > rtol for w_end in whitespace_at_end_of_line
     ):
         return "C", "{}"
     elif all(abs(whitespace - script_indent) <= ltol for whitespace in whitespace_at_start_of_line):
         # Block is left-aligned.
         return "L", "{}"
     elif all(whitespace < rtol for whitespace in whitespace_at_end_of_line) or all(
-        w_start > script_width // 2 for w_start, w_end in zip(whitespace_at_start_of_line, whitespace_at_end_of_line)
+        w_start > script_width // 2 for w_start in whitespace_at_start_of_line
     ):
         return "R", "{}"
 
@@ -171,7 +179,7 @@ def _extract_blocks(
             # There's a bit of a problem here, where if the block is too long on one speaker, then it's not two spoken blocks,
             # but we'll ignore that for now.
             # TODO: Fixme
-            block_split = [re.sub(r"\s{2,}", "+++", line.strip()).split("+++") for line in block]
+            block_split = [_WS2_RE.sub("+++", line.strip()).split("+++") for line in block]
             block_chunks = list(zip(*block_split))
             # If the length of the block chunks is the same as the length of the block, then it's two spoken blocks.
             if len(block_chunks) == len(block):
@@ -195,14 +203,14 @@ def _parse_center_aligned_block(block_lines: list) -> list:
         # There's a lot of information about the dialogue block
         speaker = block_lines[0].strip()
         # Check if there are Parentheses, and get the content inside
-        voice_modifiers = re.findall(r"\(.*?\)", speaker)
+        voice_modifiers = _PAREN_RE.findall(speaker)
         voice_modifier = []
         if voice_modifiers:
             # Get all of the voice modifiers
             for voice_modifier_string in voice_modifiers:
                 voice_modifier.append(voice_modifier_string[1:-1])
             # Remove the voice modifiers from the character name
-            speaker = re.sub(r"\(.*?\)", "", speaker).strip()
+            speaker = _PAREN_RE.sub("", speaker).strip()
 
         outputs = []
         # Split the dialogue with additional action information